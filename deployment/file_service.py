@@ -1,67 +1,19 @@
-from typing import Union, Protocol, cast as typing_cast
+from typing import Union, cast as typing_cast
 import aioboto3
 import botocore.exceptions
 import aiofiles
 import os
 from loguru import logger as logging
+from deployment.io_protocols import (
+    AsyncReadableBytesIO,
+    SyncReadableBytesIO,
+    AsyncWritableBytesIO,
+    SyncWritableBytesIO,
+)
 from deployment.temp_files import temp_file
 import io
 
 
-class AsyncReadableBytesIOA(Protocol):
-    """A type that represents a stream that can be read asynchronously"""
-
-    async def read(self, n: int) -> bytes:
-        """Reads n bytes from the file-like object"""
-        raise NotImplementedError()
-
-
-class AsyncReadableBytesIOB(Protocol):
-    """A type that represents a stream that can be read asynchronously"""
-
-    async def read(self, n: int, /) -> bytes:
-        """Reads n bytes from the file-like object"""
-        raise NotImplementedError()
-
-
-AsyncReadableBytesIO = Union[AsyncReadableBytesIOA, AsyncReadableBytesIOB]
-
-
-class SyncReadableBytesIOA(Protocol):
-    """A type that represents a stream that can be read synchronously"""
-
-    def read(self, n: int) -> bytes:
-        """Reads n bytes from the file-like object"""
-        raise NotImplementedError()
-
-
-class SyncReadableBytesIOB(Protocol):
-    """A type that represents a stream that can be read synchronously"""
-
-    def read(self, n: int, /) -> bytes:
-        """Reads n bytes from the file-like object"""
-        raise NotImplementedError()
-
-
-SyncReadableBytesIO = Union[SyncReadableBytesIOA, SyncReadableBytesIOB]
-
-
-class AsyncWritableBytesIO(Protocol):
-    """A type that represents a stream that can be written asynchronously"""
-
-    async def write(self, b: Union[bytes, bytearray], /) -> int:
-        """Writes the given bytes to the file-like object"""
-        raise NotImplementedError()
-
-
-class SyncWritableBytesIO(Protocol):
-    """A type that represents a stream that can be written synchronously"""
-
-    def write(self, b: Union[bytes, bytearray], /) -> int:
-        """Writes the given bytes to the file-like object"""
-        raise NotImplementedError()
-
-
 class S3:
     """Adapts S3 via aioboto3 to act as a file service.
 
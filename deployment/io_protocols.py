@@ -0,0 +1,58 @@
+"""Protocols for file-like objects, kept free of any third-party imports so
+that any module can use them cheaply
+"""
+from typing import Union, Protocol
+
+
+class AsyncReadableBytesIOA(Protocol):
+    """A type that represents a stream that can be read asynchronously"""
+
+    async def read(self, n: int) -> bytes:
+        """Reads n bytes from the file-like object"""
+        raise NotImplementedError()
+
+
+class AsyncReadableBytesIOB(Protocol):
+    """A type that represents a stream that can be read asynchronously"""
+
+    async def read(self, n: int, /) -> bytes:
+        """Reads n bytes from the file-like object"""
+        raise NotImplementedError()
+
+
+AsyncReadableBytesIO = Union[AsyncReadableBytesIOA, AsyncReadableBytesIOB]
+
+
+class SyncReadableBytesIOA(Protocol):
+    """A type that represents a stream that can be read synchronously"""
+
+    def read(self, n: int) -> bytes:
+        """Reads n bytes from the file-like object"""
+        raise NotImplementedError()
+
+
+class SyncReadableBytesIOB(Protocol):
+    """A type that represents a stream that can be read synchronously"""
+
+    def read(self, n: int, /) -> bytes:
+        """Reads n bytes from the file-like object"""
+        raise NotImplementedError()
+
+
+SyncReadableBytesIO = Union[SyncReadableBytesIOA, SyncReadableBytesIOB]
+
+
+class AsyncWritableBytesIO(Protocol):
+    """A type that represents a stream that can be written asynchronously"""
+
+    async def write(self, b: Union[bytes, bytearray], /) -> int:
+        """Writes the given bytes to the file-like object"""
+        raise NotImplementedError()
+
+
+class SyncWritableBytesIO(Protocol):
+    """A type that represents a stream that can be written synchronously"""
+
+    def write(self, b: Union[bytes, bytearray], /) -> int:
+        """Writes the given bytes to the file-like object"""
+        raise NotImplementedError()
@@ -1,15 +1,20 @@
 """Triggers a build by spawning the appropriate EC2 instance, configuring it,
-uploading scripts/build/, /home/ec2-user/config.sh, and /home/ec2-user/repo.sh
-into /home/ec2-user/bootstrap/ then invoking /home/ec2-user/scripts/build/main.sh
+uploading scripts/build/ (as a tarball), /home/ec2-user/config.sh, and
+/home/ec2-user/repo.sh into /usr/local/src/bootstrap/ then invoking main.sh
+from there
 
 Pass --dry-run to avoid actually spawning the instance
 """
 
 import asyncio
+import gzip
+import random
 import secrets
+import tarfile
 import time
-from typing import Awaitable, Callable, List, Tuple
+from typing import Awaitable, Callable, List
 import aioboto3
+import botocore.exceptions
 from deployment.error_middleware import handle_error
 from deployment.itgs import Itgs
 import argparse
@@ -20,16 +25,18 @@ import paramiko
 import anyio
 import anyio.to_thread
 import io
+from deployment.io_protocols import SyncWritableBytesIO
 from deployment.temp_files import temp_file
 from deployment.remote_executor import (
-    write_echo_commands_for_file,
-    write_echo_commands_for_folder,
+    write_commands_for_file,
     exec_simple,
 )
 from loguru import logger
 
 
 INSTANCE_TYPE = "c7g.4xlarge"
+REMOTE_BOOTSTRAP_TARBALL_PATH = "/home/ec2-user/bootstrap.tar.gz"
+CONNECT_TIMEOUT_SECONDS = 300
 
 
 async def main():
@@ -78,14 +85,77 @@ async def trigger_build(
     slack = await itgs.slack()
     session = aioboto3.Session()
 
-    single_file_script = await anyio.to_thread.run_sync(generate_single_file_script)
     if dry_run:
+        single_file_script = await anyio.to_thread.run_sync(generate_single_file_script)
         logger.info(f"Would have executed the following script:")
         logger.info(single_file_script)
+        with temp_file(".tar.gz") as bootstrap_tarball_path:
+            await anyio.to_thread.run_sync(
+                generate_bootstrap_tarball, bootstrap_tarball_path
+            )
+            logger.info(
+                f"Would have uploaded a {os.path.getsize(bootstrap_tarball_path)} byte bootstrap tarball"
+            )
         return
 
-    with temp_file(".pem") as key_file_path:
+    with temp_file(".pem") as key_file_path, temp_file(
+        ".tar.gz"
+    ) as bootstrap_tarball_path:
         async with session.client("ec2") as client, cleanup_functions() as cleanup:
+            # none of these depend on the instance, so we prepare them while
+            # the key pair is generated, but they're checked before launching
+            # so a failure doesn't cost us an instance. subscribing this early
+            # also ensures we can't miss build_ready
+            single_file_script_task = asyncio.create_task(
+                anyio.to_thread.run_sync(generate_single_file_script)
+            )
+            bootstrap_tarball_task = asyncio.create_task(
+                anyio.to_thread.run_sync(
+                    generate_bootstrap_tarball, bootstrap_tarball_path
+                )
+            )
+
+            async def _wait_for_prepare_tasks():
+                await asyncio.gather(
+                    single_file_script_task,
+                    bootstrap_tarball_task,
+                    return_exceptions=True,
+                )
+
+            cleanup.append(_wait_for_prepare_tasks)
+
+            seen_build_ready = asyncio.Event()
+            subscribed_to_build_ready = asyncio.Event()
+
+            async def _wait_for_build_ready():
+                try:
+                    async with Itgs() as itgs:
+                        redis = await itgs.redis()
+                        pubsub = redis.pubsub()
+                        await pubsub.subscribe("updates:frontend-ssr-web:build_ready")
+                        subscribed_to_build_ready.set()
+                        async for message in pubsub.listen():
+                            if message.get("type") == "message":
+                                break
+                        await slack.send_ops_message(
+                            "frontend-ssr-web detected build ready"
+                        )
+                        seen_build_ready.set()
+                except Exception as e:
+                    # failures before subscribing are re-raised by the main
+                    # flow (and reported by cleanup_functions); after that,
+                    # nothing awaits this task, so we report it here
+                    if subscribed_to_build_ready.is_set():
+                        await handle_error(e, extra_info="in _wait_for_build_ready")
+                    raise
+
+            build_ready_task = asyncio.create_task(_wait_for_build_ready())
+
+            async def cancel_build_ready_task():
+                build_ready_task.cancel()
+
+            cleanup.append(cancel_build_ready_task)
+
             logger.info("Generating key pair...")
             suggested_build_key_name = (
                 f"key-frontend-ssr-web-build-{secrets.token_urlsafe(6)}"
@@ -103,8 +173,7 @@ async def trigger_build(
             )
 
             key_material = response["KeyMaterial"]
-            with open(key_file_path, "w") as f:
-                f.write(key_material)
+            await anyio.to_thread.run_sync(write_key_file, key_file_path, key_material)
 
             build_key_name = response["KeyName"]
             await slack.send_ops_message(
@@ -120,6 +189,25 @@ async def trigger_build(
 
             cleanup.append(_cleanup_key)
 
+            single_file_script = await single_file_script_task
+            await bootstrap_tarball_task
+
+            subscribed_task = asyncio.create_task(subscribed_to_build_ready.wait())
+            try:
+                done, _ = await asyncio.wait(
+                    {build_ready_task, subscribed_task},
+                    timeout=60,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            finally:
+                subscribed_task.cancel()
+            if build_ready_task in done:
+                build_ready_exc = build_ready_task.exception()
+                if build_ready_exc is not None:
+                    raise build_ready_exc
+            if subscribed_task not in done:
+                raise Exception("Timed out subscribing to build_ready")
+
             logger.info("Launching instance...")
             response = await client.run_instances(
                 ImageId=build_ami_id,
@@ -167,16 +255,24 @@ async def trigger_build(
                 await slack.send_ops_message(
                     f"frontend-ssr-web terminated build server: {instance_id} (new status: {status})"
                 )
-                started_waiting_at = time.time()
-                while status not in ("non-existant", "terminated"):
-                    if time.time() - started_waiting_at > 600:
-                        raise Exception("Timed out waiting for instance to terminate")
+                if status in ("non-existant", "terminated"):
+                    return
 
-                    await asyncio.sleep(5)
+                try:
+                    await client.get_waiter("instance_terminated").wait(
+                        InstanceIds=[instance_id],
+                        WaiterConfig={"Delay": 5, "MaxAttempts": 120},
+                    )
+                except botocore.exceptions.WaiterError:
+                    # the waiter fails if the instance disappears entirely;
+                    # the status check below sorts out what happened
+                    pass
+
+                try:
                     response = await client.describe_instances(
                         InstanceIds=[instance_id]
                     )
-                    new_status = (
+                    status = (
                         response["Reservations"][0]["Instances"][0]["State"]["Name"]
                         if (
                             response["Reservations"]
@@ -184,78 +280,64 @@ async def trigger_build(
                         )
                         else "non-existant"
                     )
+                except botocore.exceptions.ClientError as e:
+                    if e.response["Error"]["Code"] != "InvalidInstanceID.NotFound":
+                        raise
+                    status = "non-existant"
 
-                    if new_status != status:
-                        status = new_status
-                        await slack.send_ops_message(
-                            f"frontend-ssr-web build server {instance_id} status: {status}"
-                        )
+                await slack.send_ops_message(
+                    f"frontend-ssr-web build server {instance_id} status: {status}"
+                )
+                if status not in ("non-existant", "terminated"):
+                    raise Exception("Timed out waiting for instance to terminate")
 
             cleanup.append(_cleanup_instance)
 
-            started_waiting_at = time.time()
-            while status != "running":
-                if time.time() - started_waiting_at > 600:
-                    raise Exception("Timed out waiting for instance to start")
-
-                await asyncio.sleep(5)
-                response = await client.describe_instances(InstanceIds=[instance_id])
-                new_status = response["Reservations"][0]["Instances"][0]["State"][
-                    "Name"
-                ]
+            await client.get_waiter("instance_running").wait(
+                InstanceIds=[instance_id],
+                WaiterConfig={"Delay": 5, "MaxAttempts": 120},
+            )
+            response = await client.describe_instances(InstanceIds=[instance_id])
+            status = response["Reservations"][0]["Instances"][0]["State"]["Name"]
+            await slack.send_ops_message(
+                f"frontend-ssr-web build server {instance_id} status: {status}"
+            )
 
-                if new_status != status:
-                    status = new_status
+            logger.info("Executing script on instance...")
+            # logs compress very well, so we compress them as they arrive
+            stdout_buf = io.BytesIO()
+            stderr_buf = io.BytesIO()
+            with gzip.GzipFile(
+                fileobj=stdout_buf, mode="wb"
+            ) as stdout_sink, gzip.GzipFile(
+                fileobj=stderr_buf, mode="wb"
+            ) as stderr_sink:
+                try:
+                    exit_status = await asyncio.wait_for(
+                        anyio.to_thread.run_sync(
+                            connect_and_execute,
+                            instance_private_ip,
+                            key_file_path,
+                            single_file_script,
+                            bootstrap_tarball_path,
+                            stdout_sink,
+                            stderr_sink,
+                        ),
+                        timeout=1800,
+                    )
+                except asyncio.TimeoutError:
+                    logger.warning("Script timed out (30m)")
                     await slack.send_ops_message(
-                        f"frontend-ssr-web build server {instance_id} status: {status}"
+                        "frontend-ssr-web build timed out (script did not complete within 30 minutes)"
                     )
+                    raise
 
-            seen_build_ready = asyncio.Event()
-
-            async def _wait_for_build_ready():
-                try:
-                    async with Itgs() as itgs:
-                        redis = await itgs.redis()
-                        pubsub = redis.pubsub()
-                        await pubsub.subscribe("updates:frontend-ssr-web:build_ready")
-                        while (
-                            await pubsub.get_message(
-                                ignore_subscribe_messages=True, timeout=5
-                            )
-                        ) is None:
-                            pass
-                        await slack.send_ops_message(
-                            "frontend-ssr-web detected build ready"
-                        )
-                        seen_build_ready.set()
-                except Exception as e:
-                    await handle_error(e, extra_info="in _wait_for_build_ready")
-                    raise e
-
-            build_ready_task = asyncio.create_task(_wait_for_build_ready())
-
-            async def cancel_build_ready_task():
-                build_ready_task.cancel()
-
-            cleanup.append(cancel_build_ready_task)
-
-            logger.info("Executing script on instance...")
-            try:
-                stdout, stderr = await asyncio.wait_for(
-                    anyio.to_thread.run_sync(
-                        connect_and_execute,
-                        instance_private_ip,
-                        key_file_path,
-                        single_file_script,
-                    ),
-                    timeout=1800,
-                )
-            except asyncio.TimeoutError:
-                logger.warning("Script timed out (30m)")
+            if exit_status != 0:
+                logger.warning(f"Script failed ({exit_status=})")
                 await slack.send_ops_message(
-                    "frontend-ssr-web build timed out (script did not complete within 30 minutes)"
+                    f"frontend-ssr-web build failed (script exited with status {exit_status})"
                 )
-                raise
+                raise Exception(f"Build script exited with status {exit_status}")
 
             logger.info("Script finished normally, waiting for build_ready...")
 
@@ -271,28 +353,22 @@ async def trigger_build(
             logger.info("build_ready detected, storing build logs...")
             await slack.send_ops_message("frontend-ssr-web storing build logs...")
 
-            with temp_file() as stdout_path, temp_file() as stderr_path:
-                with open(stdout_path, "w") as f:
-                    f.write(stdout)
-                with open(stderr_path, "w") as f:
-                    f.write(stderr)
-
-                files = await itgs.files()
-                with open(stdout_path, "rb") as f:
-                    await files.upload(
-                        f,
-                        bucket=files.default_bucket,
-                        key="builds/frontend-ssr/build-stdout.txt",
-                        sync=True,
-                    )
+            files = await itgs.files()
+            stdout_buf.seek(0)
+            await files.upload(
+                stdout_buf,
+                bucket=files.default_bucket,
+                key="builds/frontend-ssr/build-stdout.txt.gz",
+                sync=True,
+            )
 
-                with open(stderr_path, "rb") as f:
-                    await files.upload(
-                        f,
-                        bucket=files.default_bucket,
-                        key="builds/frontend-ssr/build-stderr.txt",
-                        sync=True,
-                    )
+            stderr_buf.seek(0)
+            await files.upload(
+                stderr_buf,
+                bucket=files.default_bucket,
+                key="builds/frontend-ssr/build-stderr.txt.gz",
+                sync=True,
+            )
 
             logger.info("build logs stored, cleaning up")
             await slack.send_ops_message(
@@ -329,20 +405,64 @@ async def cleanup_functions():
             raise last_e
 
 
-def generate_single_file_script() -> str:
-    res = io.StringIO()
-    res.write("cd /usr/local/src\n")
-    write_echo_commands_for_folder("scripts/build", "bootstrap", res)
-    write_echo_commands_for_file("/home/ec2-user/config.sh", "bootstrap/config.sh", res)
-    write_echo_commands_for_file("/home/ec2-user/repo.sh", "bootstrap/repo.sh", res)
-    res.write("cd /usr/local/src/bootstrap\n")
-    res.write("bash main.sh\n")
-    return res.getvalue()
+def write_key_file(path: str, key_material: str) -> None:
+    """Writes the given private key to the given path such that it's only
+    readable by the current user, as ssh expects
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(key_material)
+
+
+def generate_bootstrap_tarball(out_path: str) -> None:
+    """Writes a gzipped tarball of scripts/build to the given path. This is
+    uploaded alongside the script from generate_single_file_script, which
+    extracts it into /usr/local/src/bootstrap
+    """
+    with tarfile.open(out_path, mode="w:gz") as tar:
+        tar.add("scripts/build", arcname=".", filter=_reset_tar_owner)
+
+
+def _reset_tar_owner(info: tarfile.TarInfo) -> tarfile.TarInfo:
+    """Makes the given tarball entry owned by root, since extracting as root
+    would otherwise restore the build host's uid/gid
+    """
+    info.uid = 0
+    info.gid = 0
+    info.uname = "root"
+    info.gname = "root"
+    return info
 
 
-def connect_and_execute(ip: str, key_file_path: str, script: str) -> Tuple[str, str]:
+def generate_single_file_script() -> str:
+    parts: List[str] = [
+        "cd /usr/local/src\n",
+        "mkdir -p bootstrap\n",
+        f"tar -xzf {REMOTE_BOOTSTRAP_TARBALL_PATH} -C bootstrap\n",
+    ]
+    write_commands_for_file("/home/ec2-user/config.sh", "bootstrap/config.sh", parts)
+    write_commands_for_file("/home/ec2-user/repo.sh", "bootstrap/repo.sh", parts)
+    parts.append("find bootstrap -type f -name '*.sh' -exec chmod +x {} +\n")
+    parts.append("cd /usr/local/src/bootstrap\n")
+    parts.append("bash main.sh\n")
+    return "".join(parts)
+
+
+def connect_and_execute(
+    ip: str,
+    key_file_path: str,
+    script: str,
+    bootstrap_tarball_path: str,
+    stdout_sink: SyncWritableBytesIO,
+    stderr_sink: SyncWritableBytesIO,
+) -> int:
     client = None
-    for attempt in range(150):
+    started_at = time.time()
+    attempt = 0
+    while True:
+        # if sshd is still starting, we want the first few attempts to fail
+        # fast
+        handshake_timeout = 2 if attempt < 3 else 10
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         try:
@@ -351,14 +471,24 @@ def connect_and_execute(ip: str, key_file_path: str, script: str) -> Tuple[str,
                 username="ec2-user",
                 key_filename=key_file_path,
                 look_for_keys=False,
-                auth_timeout=5,
-                banner_timeout=5,
+                timeout=handshake_timeout,
+                auth_timeout=handshake_timeout,
+                banner_timeout=handshake_timeout,
             )
+            transport = client.get_transport()
+            if transport is not None:
+                # builds can go quiet for a while; keep idle firewalls/NATs
+                # from dropping the connection
+                transport.set_keepalive(30)
+                # builds can emit a lot of output; avoid rekeying mid-stream.
+                # this applies to every channel on this connection
+                transport.packetizer.REKEY_BYTES = pow(2, 40)
             sftp = client.open_sftp()
-            with sftp.open("/home/ec2-user/initial_script.sh", "w") as remote_file:
-                remote_file.write(script)
-
-            sftp.chmod("/home/ec2-user/initial_script.sh", 0o755)
+            sftp.put(bootstrap_tarball_path, REMOTE_BOOTSTRAP_TARBALL_PATH)
+            # putfo pipelines the writes rather than waiting on each block
+            sftp.putfo(
+                io.BytesIO(script.encode("utf-8")), "/home/ec2-user/initial_script.sh"
+            )
             sftp.close()
         except Exception:
             msg = f"Failed to connect to {ip} on attempt {attempt}"
@@ -366,9 +496,10 @@ def connect_and_execute(ip: str, key_file_path: str, script: str) -> Tuple[str,
                 logger.trace(msg)
             else:
                 logger.warning(msg)
-            if attempt == 149:
+            if time.time() - started_at > CONNECT_TIMEOUT_SECONDS:
                 raise
-            time.sleep(2)
+            time.sleep(min(10.0, 0.5 * (1.5**attempt)) * (0.5 + random.random()))
+            attempt += 1
             continue
         break
 
@@ -376,13 +507,16 @@ def connect_and_execute(ip: str, key_file_path: str, script: str) -> Tuple[str,
         raise Exception("Failed to connect to {ip} (client is None)")
 
     logger.info(f"Successfully connected to {ip}, executing script...")
-    stdout, stderr = exec_simple(client, "sudo bash /home/ec2-user/initial_script.sh")
+    exit_status = exec_simple(
+        client,
+        "sudo bash /home/ec2-user/initial_script.sh",
+        stdout_sink=stdout_sink,
+        stderr_sink=stderr_sink,
+    )
     client.close()
 
-    logger.trace(f"stdout: {stdout}")
-    logger.trace(f"stderr: {stderr}")
-    logger.info(f"Done executing script on {ip}")
-    return stdout, stderr
+    logger.info(f"Done executing script on {ip} ({exit_status=})")
+    return exit_status
 
 
 if __name__ == "__main__":